@@ -79,6 +79,7 @@ This file is part of d∃∀duction.
     with dEAduction.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+from collections import deque
 from copy import copy
 import logging
 
@@ -186,28 +187,40 @@ class MarkedTree:
         if self.is_marked:
             return self
 
-        marked_descendant = []
+        marked_descendant = None
         # for child in self.ordered_children():
         for child in self.children:
             if child is self:
                 continue
             new_marked_descendant = child.marked_descendant()
             if new_marked_descendant:
-                marked_descendant.append(new_marked_descendant)
+                if marked_descendant:
+                    raise ValueError(f"Several marked descendants in {self}")
+                marked_descendant = new_marked_descendant
 
-        if marked_descendant:
-            if len(marked_descendant) == 1:
-                return marked_descendant[0]
-            else:
-                raise ValueError(f"Several marked descendants in {self}")
+        return marked_descendant
+
+    def first_marked_descendant(self):
+        """
+        Return the first marked descendant of self found, if any. Contrary to
+        marked_descendant(), this stops at the first hit and does not check
+        that it is unique.
+        """
+        nodes = [self]
+        while nodes:
+            node = nodes.pop()
+            if node.is_marked:
+                return node
+            nodes.extend(child for child in node.children
+                         if child is not node)
 
     @property
     def has_marked_descendant(self) -> bool:
-        return bool(self.marked_descendant())
+        return self.first_marked_descendant() is not None
 
     def child_with_marked_descendant(self):
         for child in self.children:
-            if child.marked_descendant():
+            if child.first_marked_descendant() is not None:
                 return child
 
     def mark(self):
@@ -484,6 +497,25 @@ class MarkedTree:
             if parent:
                 return parent
 
+    def lineage_from(self, descendant) -> Optional[list]:
+        """
+        Return [descendant, parent of descendant, ..., self], i.e. the
+        successive results of parent_of() computed in a single walk,
+        or None if descendant is not in self's subtree.
+        """
+
+        if self is descendant:
+            return [self]
+
+        if descendant in self.children:
+            return [descendant, self]
+
+        for child in self.children:
+            lineage = child.lineage_from(descendant)
+            if lineage:
+                lineage.append(self)
+                return lineage
+
     # def father_of_marked_descendant(self):
     #     pass
 
@@ -836,22 +868,18 @@ def in_this_order(self, other, list_):
     are in the reverse order.
     """
     yes = None
-    both_in = False
     for item in list_:
         if item is self:
             if yes is None:  # self is first
                 yes = True
             elif yes is False:  # self is second
-                both_in = True
+                return False
         elif item is other:
             if yes:  # other is second
-                both_in = True
+                return True
             else:  # other is first
                 yes = False
 
-    if both_in:
-        return yes
-
 
 class MarkedPatternMathObject(PatternMathObject, MarkedTree):
     """
@@ -864,6 +892,9 @@ class MarkedPatternMathObject(PatternMathObject, MarkedTree):
     applications_from_ctxt = []
 
     _math_cursor: MathCursor = None
+    # (math_cursor, {cursor position and options: descendants}), see
+    # ordered_descendants()
+    _ordered_descendants_cache = None
 
     @classmethod
     def from_pattern_math_object(cls, pmo: PatternMathObject):
@@ -879,9 +910,11 @@ class MarkedPatternMathObject(PatternMathObject, MarkedTree):
                     if isinstance(child, MetaVar)
                     else cls.from_pattern_math_object(child)
                     for child in pmo.children]
-        # NO_MATH_TYPE should be kept identical
-        marked_type = (pmo.math_type if pmo.math_type.is_no_math_type()
-                       else copy(pmo.math_type))
+        # Only metavar types are modified (assigned) by matching; other
+        # types, including NO_MATH_TYPE, are shared.
+        math_type = pmo.math_type
+        marked_type = (copy(math_type) if isinstance(math_type, MetaVar)
+                       else math_type)
         if pmo.is_bound_var:
             marked_pmo = MarkedBoundVar(node=pmo.node, info=pmo.info,
                                         children=children,
@@ -917,9 +950,8 @@ class MarkedPatternMathObject(PatternMathObject, MarkedTree):
         MathCursor, to avoid perturbing formatters ('highlight').
         """
 
-        marked_descendant = None
-        if self.marked_descendant():
-            marked_descendant = self.marked_descendant()
+        marked_descendant = self.marked_descendant()
+        if marked_descendant:
             marked_descendant.unmark()
 
         self._math_cursor = MathCursor(self, marked_descendant, go_to_end)
@@ -943,37 +975,46 @@ class MarkedPatternMathObject(PatternMathObject, MarkedTree):
         This is built from the linear math_list, i.e. the list of MathString
         corresponding to the display of self, by replacing each string by the
         math_object it comes from. Only MarkedPatternMathObject are kept.
+
+        The math_list is a snapshot of self taken by set_math_cursor(),
+        so the result only depends on the math_cursor and its position: it is
+        cached, and should not be modified.
         """
 
         # Fixme: include descendant of MathList, not only MathString
         #  when a MathList has no symbol whose descendant is self
 
+        math_cursor = self.math_cursor
         if include_cursor or only_before or only_after:
-            self.math_cursor.show_cursor()
-
-        until = self.math_cursor.deaduction_cursor if only_before else None
-        from_ = self.math_cursor.deaduction_cursor if only_after else None
-
-        linear_list = self.math_list().linear_list(until=until, from_=from_)
-
-        log.debug(f"Linear list with nodes: {linear_list}")
-        # Fixme: most of the following is useless
-        descendants = []
-        for item in linear_list:
-            descendant = item.descendant
-            # We need to remove MathObject.NO_MATH_TYPE
-            if item == self.math_cursor.deaduction_cursor:
-                if only_before:  # List completed
-                    break
-                elif only_after:  # Actual list starts here
-                    descendants = []
-                elif include_cursor:
-                    descendants.append(item)
-            elif isinstance(descendant, MarkedPatternMathObject):
-                descendants.append(descendant)
+            math_cursor.show_cursor()
+
+        cache = self._ordered_descendants_cache
+        if not cache or cache[0] is not math_cursor:
+            cache = (math_cursor, dict())
+            self._ordered_descendants_cache = cache
+        key = (math_cursor.cursor_address, math_cursor.cursor_is_after,
+               include_cursor, only_before, only_after)
+        descendants = cache[1].get(key)
+
+        if descendants is None:
+            # Fixme: most of the following is useless
+            descendants = []
+            for item in self.math_list().linear_items():
+                descendant = item.descendant
+                # We need to remove MathObject.NO_MATH_TYPE
+                if item == math_cursor.deaduction_cursor:
+                    if only_before:  # List completed
+                        break
+                    elif only_after:  # Actual list starts here
+                        descendants = []
+                    elif include_cursor:
+                        descendants.append(item)
+                elif isinstance(descendant, MarkedPatternMathObject):
+                    descendants.append(descendant)
+            cache[1][key] = descendants
 
         if include_cursor:
-            self.math_cursor.hide_cursor()
+            math_cursor.hide_cursor()
 
         return descendants
 
@@ -984,12 +1025,12 @@ class MarkedPatternMathObject(PatternMathObject, MarkedTree):
 
     def left_descendants(self):
         ld = self.ordered_descendants(only_before=True)
-        log.debug(f"Left descendants: {ld}")
+        log.debug("Left descendants: %s", ld)
         return ld
 
     def right_descendants(self):
         rd = self.ordered_descendants(only_after=True)
-        log.debug(f"Right descendants: {rd}")
+        log.debug("Right descendants: %s", rd)
         return rd
 
     def leaf_just_before_cursor(self):
@@ -1002,15 +1043,45 @@ class MarkedPatternMathObject(PatternMathObject, MarkedTree):
         if right_descendants:
             return right_descendants[0]
 
+    def descendant_ids(self, only_before=False, only_after=False) -> set:
+        """
+        Return the set of ids of self.ordered_descendants(only_before,
+        only_after), cached along with it.
+        """
+        descendants = self.ordered_descendants(only_before=only_before,
+                                               only_after=only_after)
+        cache = self._ordered_descendants_cache[1]
+        key = ('ids', only_before, only_after, id(descendants))
+        ids = cache.get(key)
+        if ids is None:
+            ids = {id(descendant) for descendant in descendants}
+            cache[key] = ids
+        return ids
+
+    def appears_in_descendants(self, other,
+                               only_before=False, only_after=False) -> bool:
+        """
+        Same as other in self.ordered_descendants(only_before, only_after),
+        but with a set lookup. BoundVar.__eq__ is not identity, so we fall
+        back to the list test for those.
+        """
+        if id(other) in self.descendant_ids(only_before=only_before,
+                                            only_after=only_after):
+            return True
+        elif isinstance(other, BoundVar):
+            return other in self.ordered_descendants(only_before=only_before,
+                                                     only_after=only_after)
+        return False
+
     def appears_left_of_cursor(self, other) -> bool:
         """
         True iff there is an item on the left of cursor whose
         associated math_object is other.
         """
-        return other in self.left_descendants()
+        return self.appears_in_descendants(other, only_before=True)
 
     def appears_right_of_cursor(self, other) -> bool:
-        return other in self.right_descendants()
+        return self.appears_in_descendants(other, only_after=True)
 
     def cursor_is_after_marked_descendant(self) -> bool:
         """
@@ -1186,12 +1257,23 @@ class MarkedPatternMathObject(PatternMathObject, MarkedTree):
         left, central, right.
         Left children are the ones are before the first 'self' in
         self.ordered_descendants.
+        The result is cached along with self.ordered_descendants(),
+        and should not be modified.
         """
-        left = []
-        central = []
 
         # children = self.ordered_children()
         children = self.ordered_descendants()
+        cache = self._ordered_descendants_cache[1]
+        key = ('partition', id(children))
+        partition = cache.get(key)
+        if partition is None:
+            partition = self._partition(children)
+            cache[key] = partition
+        return partition
+
+    def _partition(self, children):
+        left = []
+        central = []
 
         left_or_central = left
         idx = -1
@@ -1218,18 +1300,34 @@ class MarkedPatternMathObject(PatternMathObject, MarkedTree):
             return left, [], left_or_central
 
     def partionned_mvars(self, unassigned=False) -> [[PatternMathObject]]:
+        """
+        Return fresh copies (callers pop from them) of the partionned
+        mvars, which are cached like partionned_children().
+        """
         lists = self.partionned_children()
-        descendant_lists = ([], [], [])
-        for l, new_l in zip(lists, descendant_lists):
-            for child in l:
-                if child.is_metavar:
-                    new_l.append(child)
+        cache = self._ordered_descendants_cache[1]
+        key = ('mvars', id(lists))
+        mvar_lists = cache.get(key)
+        if mvar_lists is None:
+            mvar_lists = tuple([child for child in l if child.is_metavar()]
+                               for l in lists)
+            cache[key] = mvar_lists
 
-        return descendant_lists
+        return tuple(list(l) for l in mvar_lists)
 
     def set_cursor_at(self, mvar, pos=None):
         self.math_cursor.go_to(mvar)
 
+    def mark_first_mvar(self, unassigned=True):
+        """
+        Mark the first (unassigned) mvar of self, if any, and return it.
+        """
+        mvar = self.first_mvar(unassigned=unassigned)
+        if mvar:
+            self.unmark()
+            mvar.mark()
+        return mvar
+
     # def set_cursor_at_main_symbol(self):
     #     idx, ms = self.main_shape_symbol()
     #     self.cursor_pos = idx
@@ -1246,13 +1344,12 @@ class MarkedPatternMathObject(PatternMathObject, MarkedTree):
         Also if mvar affects the type of a bound_var.
         """
 
-        parent = self.parent_of(mvar)
-        if not parent:
+        lineage = self.lineage_from(mvar)
+        if not lineage:
             return
-        if parent.has_bound_var() and mvar == parent.children[0]:
-            return parent.bound_var
-        else:
-            return self.bound_var_affected_by(parent)
+        for child, parent in zip(lineage, lineage[1:]):
+            if parent.has_bound_var() and child == parent.children[0]:
+                return parent.bound_var
 
     def priority_test(self, parent, left_children):
         """
@@ -1441,27 +1538,29 @@ class MarkedPatternMathObject(PatternMathObject, MarkedTree):
 
         left_mvars, central_mvars, right_mvars = \
             new_pmo.partionned_mvars(unassigned=True)
-        pmo_display = new_pmo.to_display(format_='utf8')
+        # Avoid computing displays when not logged
+        pmo_display = (new_pmo.to_display(format_='utf8')
+                       if log.isEnabledFor(logging.DEBUG) else None)
 
         left_insertion = False
         central_insertion = False
         right_insertion = False
         math_object = mvar.assigned_math_object
         if left:
-            log.debug(f"--> Trying to match left mvars {left_mvars}"
-                      f" of {pmo_display} with {math_object}")
+            log.debug("--> Trying to match left mvars %s of %s with %s",
+                      left_mvars, pmo_display, math_object)
             left_insertion = self.assign(left_mvars, math_object,
                                          assignments, check_types)
 
         if not left_insertion and right:
-            log.debug(f"--> Trying to match right mvars {right_mvars}"
-                      f" of{pmo_display} with {math_object}")
+            log.debug("--> Trying to match right mvars %s of %s with %s",
+                      right_mvars, pmo_display, math_object)
             right_insertion = self.assign(right_mvars, math_object,
                                           assignments, check_types)
 
         if not (left_insertion or right_insertion):
-            log.debug(f"--> Trying to match central mvars {central_mvars}"
-                      f" of {pmo_display} with {math_object}")
+            log.debug("--> Trying to match central mvars %s of %s with %s",
+                      central_mvars, pmo_display, math_object)
             central_insertion = self.assign(central_mvars, math_object,
                                             assignments, check_types)
 
@@ -1484,23 +1583,26 @@ class MarkedPatternMathObject(PatternMathObject, MarkedTree):
                                if left_insertion else
                                (left_mvars, self.first_left_descendants(mvar))
                                )
-        display = [child.to_display(format_='utf8')
-                   for child in bad_children]
-        log.debug(f"--> Bad children: {display}")
+        if log.isEnabledFor(logging.DEBUG):
+            display = [child.to_display(format_='utf8')
+                       for child in bad_children]
+            log.debug("--> Bad children: %s", display)
 
         # (C-2) move bad children
         # FIXME: algo should be symmetric but is not,
         #  this can be a problem in case of multiple mvars.
         mvar_to_be_cleared = []
+        bad_children = deque(bad_children)
+        mvars = deque(mvars)
         while bad_children:
-            child = bad_children.pop(0)
+            child = bad_children.popleft()
             math_child = child.assigned_math_object
             if not math_child:
                 continue
 
             success = False
             while mvars:
-                pmo_mvar = mvars.pop(0)
+                pmo_mvar = mvars.popleft()
                 # if math_child:
                 if pmo_mvar.match(math_child, successive_matching=True):
                     # Success for this child!
@@ -1517,11 +1619,11 @@ class MarkedPatternMathObject(PatternMathObject, MarkedTree):
                     break
             if not success:
                 # last mvar did not match
-                log.debug(f"unable to assign child {child}")
+                log.debug("unable to assign child %s", child)
                 return False
             else:
                 [child.clear_assignment() for child in mvar_to_be_cleared]
-                log.debug(f"Child {math_child} assigned to {pmo_mvar}")
+                log.debug("Child %s assigned to %s", math_child, pmo_mvar)
 
         return True
 
@@ -1548,8 +1650,9 @@ class MarkedPatternMathObject(PatternMathObject, MarkedTree):
         left = self.appears_left_of_cursor(mvar)
         right = self.appears_right_of_cursor(mvar)
 
-        pmo_display = new_pmo.to_display(format_='utf8')
-        log.debug(f"Trying to insert {pmo_display} at {mvar}")
+        if log.isEnabledFor(logging.DEBUG):
+            pmo_display = new_pmo.to_display(format_='utf8')
+            log.debug("Trying to insert %s at %s", pmo_display, mvar)
         # log.debug(f"left/right of cursor = {left, right}")
         # log.debug(f"Parent mvar = {parent_mvar}")
 
@@ -1616,18 +1719,15 @@ class MarkedPatternMathObject(PatternMathObject, MarkedTree):
                 if success:
                     return mvar
 
-            parent_mvar = self.parent_of(mvar)
-
-            while mvar:
+            # Try mvar and then all its metavar ancestors
+            lineage = self.lineage_from(mvar) or [mvar]
+            for mvar in lineage:
+                if not mvar.is_metavar():
+                    continue
                 success = self.insert_if_you_can(new_pmo_copy, mvar)
                 if success:
                     return mvar
 
-                mvar = parent_mvar
-                parent_mvar = self.parent_of(parent_mvar)
-                if mvar and not mvar.is_metavar():
-                    continue
-
     def insert_application(self, pattern=None):
         """
         Try to insert an APPLICATION, with marked_descendant as its first
@@ -1672,7 +1772,7 @@ class MarkedPatternMathObject(PatternMathObject, MarkedTree):
                 continue
             child = left_children[0]
             # log.debug(f"Try to match {math_object} with {child}")
-            if child.is_metavar and child.match(math_object):
+            if child.is_metavar() and child.match(math_object):
                 new_pmo = app_pattern.deep_copy(app_pattern)
                 left_children, _, _ = new_pmo.partionned_children()
                 if not left_children:
@@ -1904,8 +2004,9 @@ class MarkedPatternMathObject(PatternMathObject, MarkedTree):
         'Delete' current marked metavar, i.e. remove assigned_math_object.
         """
 
-        if self.marked_descendant():
-            success = self.marked_descendant().delete()
+        marked_descendant = self.marked_descendant()
+        if marked_descendant:
+            success = marked_descendant.delete()
             if success:
                 # FIXME: this does not work anymore
                 # self.set_cursor_at(self.marked_descendant(), 0)
@@ -1941,35 +2042,32 @@ class MarkedMetavar(MetaVar, MarkedPatternMathObject):
         """
         Override super().node.
         """
-        node = (self.assigned_math_object.node
-                if self.assigned_math_object else self._node)
-        return node
+        math_object = self.assigned_math_object
+        return math_object.node if math_object else self._node
 
     @property
     def info(self):
         """
         Override super().children in case self has a assigned_math_object.
         """
-        info = (self.assigned_math_object.info
-                if self.assigned_math_object else self._info)
-        return info
+        math_object = self.assigned_math_object
+        return math_object.info if math_object else self._info
 
     @property
     def children(self):
         """
         Override super().children in case self has a assigned_math_object.
         """
-        children = (self.assigned_math_object.children
-                    if self.assigned_math_object else self._children)
-        return children
+        math_object = self.assigned_math_object
+        return math_object.children if math_object else self._children
 
     @property
     def math_type(self):
         """
         Override super().children in case self has a assigned_math_object.
         """
-        math_type = (self.assigned_math_object.math_type
-                     if self.assigned_math_object else self._math_type)
+        math_object = self.assigned_math_object
+        math_type = math_object.math_type if math_object else self._math_type
         return self.NO_MATH_TYPE if math_type is None else math_type
 
     @classmethod
@@ -1985,8 +2083,10 @@ class MarkedMetavar(MetaVar, MarkedPatternMathObject):
         """
         if self.assigned_math_object:
             self.assigned_math_object = None
-            if isinstance(self.math_type, MetaVar):
-                self.math_type.assigned_math_object = None
+            # NB: math_type must be read after clearing the assignment
+            math_type = self.math_type
+            if isinstance(math_type, MetaVar):
+                math_type.assigned_math_object = None
             return True
 
 
@@ -2007,9 +2107,10 @@ class MarkedBoundVar(BoundVar, MarkedPatternMathObject):
 
     @property
     def name(self):
-        name = self.info.get('name')
+        info = self.info
+        name = info.get('name')
         if name == 'NO NAME':
-            lean_name = self.info.get('lean_name')
+            lean_name = info.get('lean_name')
             name = '[' + lean_name + ']' if lean_name else '[?]'
         return name
 
@@ -604,6 +604,9 @@ class MathDisplay:
                   {'PROP_EQUAL', 'PROP_<', 'PROP_>', 'PROP_≤', 'PROP_≥'},
                   # {'CLOSE_PARENTHESIS', 'OPEN_PARENTHESIS'}
                   ]
+    # node -> index of its set in priorities
+    priority_levels = {node: level for level, nodes in enumerate(priorities)
+                       for node in nodes}
 
     @classmethod
     def priority(cls, self: str, other: str) -> str:
@@ -616,21 +619,16 @@ class MathDisplay:
 
         if not self or not other:
             return None
-        self_found = False
-        other_found = False
-        for nodes in cls.priorities:
-            if self in nodes:
-                if other_found:
-                    return '<'
-                if other in nodes:
-                    return '='
-                else:
-                    self_found = True
-            elif other in nodes:
-                if self_found:
-                    return '>'
-                else:
-                    other_found = True
+        self_level = cls.priority_levels.get(self)
+        other_level = cls.priority_levels.get(other)
+        if self_level is None or other_level is None:
+            return None
+        elif self_level < other_level:
+            return '>'
+        elif self_level > other_level:
+            return '<'
+        else:
+            return '='
 
     @classmethod
     def priority_test(cls, child_node, parent_node, child_number):
@@ -640,14 +638,15 @@ class MathDisplay:
         parentheses are needed, None if both  nodes are not in the priority
         list.
         """
-        if not cls.priority(parent_node, child_node):
+        priority = cls.priority(parent_node, child_node)
+        if not priority:
             return None
         if child_number == 0:
             # self can be a left (first) child of parent with no parentheses?
-            test = (cls.priority(parent_node, child_node) != '>')
+            test = (priority != '>')
         else:
             # self can be a right child of parent?
-            test = (cls.priority(parent_node, child_node) not in ('=', '>'))
+            test = (priority not in ('=', '>'))
         return test
 
     @classmethod
@@ -241,7 +241,7 @@ class MathCursor:
         return position
 
     def debug(self):
-        log.debug(str(self))
+        log.debug("%s", self)
         # pass
         # self.show_cursor()
         # log.debug(f"Math cursor: {self.math_list}")
@@ -431,9 +431,11 @@ class MathCursor:
         item = self.current_item
         test1 = any((item.is_formatter(), item.is_format_parenthesis(),
                     item.is_marker()))
-        type_ = type(self.current_math_object)
-        test2 = str(type_).endswith(".MarkedMetavar'>")
-        return test1 or not test2
+        if test1:
+            return True
+        # Avoid importing MarkedMetavar (circular import), and str(type_)
+        test2 = type(self.current_math_object).__name__ == "MarkedMetavar"
+        return not test2
 
     def minimal_increase_pos(self):
         """
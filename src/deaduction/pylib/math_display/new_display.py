@@ -971,6 +971,22 @@ class MathList(list, MathDescendant):
 
         return linear_list
 
+    def linear_items(self):
+        """
+        Iterate over the items of self.linear_list(), without building the
+        intermediate lists.
+        """
+
+        stack = [iter(self)]
+        while stack:
+            for item in stack[-1]:
+                if isinstance(item, MathList):
+                    stack.append(iter(item))
+                    break
+                yield item
+            else:
+                stack.pop()
+
     # def descendants_with_nodes(self, until=None, from_=None):
     #     """
     #     Return the linear MathList of descendants of self.
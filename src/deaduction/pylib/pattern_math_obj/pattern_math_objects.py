@@ -686,7 +686,16 @@ class MetaVar(PatternMathObject):
 
     @classmethod
     def deep_copy(cls, self, original_bound_vars=None, copied_bound_vars=None):
-        new_mvar = super().deep_copy(self)
+        """
+        Copy math_type and assigned_math_object. Unlike super().deep_copy(),
+        do not copy info and children: __init__ ignores them, and for some
+        subclasses they are those of the (big) assigned_math_object, which
+        would thus be copied twice.
+        """
+        math_type = self.math_type
+        new_math_type = (math_type if math_type.is_no_math_type()
+                         else math_type.deep_copy(math_type))
+        new_mvar = cls(math_type=new_math_type)
         mmo = self.assigned_math_object
         if mmo:
             new_mvar.assigned_math_object = mmo.deep_copy(mmo)
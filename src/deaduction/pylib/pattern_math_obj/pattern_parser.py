@@ -28,6 +28,7 @@ This file is part of d∃∀duction.
 
 from typing import Any, Optional
 from dataclasses import dataclass
+from functools import lru_cache
 from parsimonious.grammar import Grammar
 from parsimonious.nodes import NodeVisitor
 import logging
@@ -163,9 +164,16 @@ class PatternEntryVisitor(NodeVisitor):
         return visited_children
 
 
+pattern_visitor = PatternEntryVisitor()
+
+
+# Pattern strings are mostly literals which are parsed again and again.
+# Returned trees are shared, they must not be modified (they are only read by
+# PatternMathObject.from_tree, which builds new objects at each call).
+@lru_cache(maxsize=1024)
 def tree_from_str(s: str) -> Tree:
     parsed_tree = pattern_grammar.parse(s)
-    tree = PatternEntryVisitor().visit(parsed_tree)
+    tree = pattern_visitor.visit(parsed_tree)
     return tree
 
 
@@ -31,6 +31,7 @@ This file is part of d∃∀duction.
 
 import trio
 import logging
+from collections import deque
 from time import time
 from typing import Optional, Dict
 
@@ -115,10 +116,12 @@ class Task:
 #####################
 # ServerQueue class #
 #####################
-class ServerQueue(list):
+class ServerQueue(deque):
     """
-    This class stores a list of pending task for Lean server, and launches the
-    first task in the list when the previous task is done.
+    This class stores a queue of pending task for Lean server, and launches
+    the first task in the queue when the previous task is done.
+    Tasks are popped from the right end, so that both adding a task on top
+    (right) or at the end of the queue (left) are O(1).
     The "next_task" method is also responsible for the timeout: if the task
     is not done within TIMEOUT, then the request is sent another time with
     doubled timeout, and again until NB_TRIALS is reached.
@@ -168,7 +171,7 @@ class ServerQueue(list):
             self.log.debug(f"Adding task on top")
         else:
             self.log.debug(f"Adding task")
-            self.insert(0, task)
+            self.appendleft(task)
         if not self.is_busy:  # Execute task immediately
             self.is_busy = True
             self.queue_ended = trio.Event()
@@ -213,9 +216,6 @@ class ServerQueue(list):
             self.actual_timeout = self.TIMEOUT
         while nb < self.NB_TRIALS:
             nb += 1
-            # The following try block is here because of some error occurring
-            # sometimes when cancelling trio.
-            # try:
             with trio.move_on_after(self.actual_timeout) \
                     as self.cancel_scope:
                 # Await Lean Server starts!
@@ -226,7 +226,7 @@ class ServerQueue(list):
                 task.start_time = time()
                 await task.fct(task, **task.kwargs)
                 task.end_time = time()
-                print(f"task duration: {task.duration}")
+                self.log.debug(f"task duration: {task.duration}")
                 if task.pertinent_duration:
                     self.task_durations.append(task.duration)
                     # print(f"task durations: {self.task_durations}")
@@ -254,33 +254,6 @@ class ServerQueue(list):
                         task.status = 'cancelled'
             else:
                 break
-            # except TypeError as e:
-            #     self.log.debug("TypeError while cancelling trio")
-            #     self.log.debug(e)
-            #     error_type = 0
-            #     if task.status == "cancellation_required":
-            #         error_type = 7
-            #     else:
-            #         self.log.warning(f"No answer within "
-            #                          f"{self.actual_timeout}s (trial {nb})")
-            #         error_type = 3
-            #         self.actual_timeout = 2 * self.actual_timeout
-            #     no_more_trials = (nb == self.NB_TRIALS
-            #                       or task.status == "cancellation_required")
-            #     if no_more_trials:
-            #         # Task definitively  cancelled!
-            #         # Emit lean_response signal with timeout error
-            #         lean_response = LeanResponse(error_type=error_type)
-            #         self.timeout_signal.emit(lean_response)
-            #         break
-            #     else:  # Task will be tried again
-            #         if task.cancel_fct:
-            #             task.cancel_fct()
-            #             task.status = 'cancelled'
-            #
-            # except Exception as e:
-            #     self.log.debug(e)
-            #     raise
 
         # Launch next task when done!
         task.status = 'done'
@@ -460,12 +433,16 @@ class ServerInterface(QObject):
 
     def __add_time_to_cancel_scope(self):
         """
-        Reset the deadline of the cancel_scope.
+        Reset the deadline of the cancel_scope. Lean messages come in
+        bursts, so the deadline is not moved by less than 0.1s: this
+        spares trio a rescheduling of the scope at each message.
         """
-        if self.server_queue.cancel_scope:
+        cancel_scope = self.server_queue.cancel_scope
+        if cancel_scope:
             time = self.server_queue.actual_timeout
-            self.server_queue.cancel_scope.deadline = (trio.current_time()
-                                                       + time)
+            deadline = trio.current_time() + time
+            if deadline - cancel_scope.deadline >= 0.1:
+                cancel_scope.deadline = deadline
 
     def __on_lean_state_change(self, is_running: bool):
         self.__add_time_to_cancel_scope()
@@ -474,15 +451,13 @@ class ServerInterface(QObject):
             self.log.info(f"New lean state: {is_running}")
             self.is_running = is_running
 
-    def __check_request_complete(self, request_seq_num):
-        self.log.debug(f"Checking request {request_seq_num}")
-        request = self.pending_requests.get(request_seq_num)
-        if request:
-            if request.is_complete():
-                self.log.debug("--> complete")
-                request.set_proof_received()
-            else:
-                self.log.debug("--> not complete")
+    def __check_request_complete(self, request):
+        self.log.debug(f"Checking request {request.seq_num}")
+        if request.is_complete():
+            self.log.debug("--> complete")
+            request.set_proof_received()
+        else:
+            self.log.debug("--> not complete")
 
     def __on_lean_message(self, msg: Message):
         """
@@ -510,9 +485,8 @@ class ServerInterface(QObject):
 
         self.__add_time_to_cancel_scope()
 
-        if msg.seq_num in self.pending_requests:
-            request = self.pending_requests[msg.seq_num]
-        else:
+        request = self.pending_requests.get(msg.seq_num)
+        if request is None:
             self.log.debug(f"ignoring msg from seq_num {msg.seq_num}")
             return
 
@@ -544,12 +518,8 @@ class ServerInterface(QObject):
                 self.log.debug("Processing effective code")
                 request.process_effective_code(txt)
                 check_complete = True
-            # if request.effective_code_received:
-            #     self.history_replace(request.effective_code)
-            #     # self.effective_code_received.emit(request.effective_code)
-            #     request.effective_code_received = False
         if check_complete:
-            self.__check_request_complete(msg.seq_num)
+            self.__check_request_complete(request)
 
     ############################################
     # Message filtering
@@ -582,6 +552,13 @@ class ServerInterface(QObject):
         self.error_send.send_nowait(msg)
         request.proof_received_event.set()  # Done receiving
 
+    def __received_errors(self) -> list:
+        """
+        Empty the errors channel and return the list of errors it contained.
+        """
+        nb = self.error_recv.statistics().current_buffer_used
+        return [self.error_recv.receive_nowait() for _ in range(nb)]
+
     ##########################################
     # Update proof state of current exercise #
     ##########################################
@@ -606,11 +583,12 @@ class ServerInterface(QObject):
             # Update the lean text editor:
             self.lean_file_changed.emit(self.lean_file.inner_contents)
 
-        if hasattr(self.update_started, "emit"):
-            self.update_started.emit()
+        self.update_started.emit()
 
         # Invalidate events
         self.file_invalidated = trio.Event()
+        # Discard errors left by a previous, cancelled request
+        self.__received_errors()
 
         resp = None
         error_type = 0
@@ -632,7 +610,7 @@ class ServerInterface(QObject):
                               content=request.file_contents())
             resp = await self.lean_server.send(req)
             if not resp:
-                self.pending_requests.pop(self.request_seq_num)
+                self.pending_requests.pop(self.request_seq_num, None)
 
         # (3) Several types of response: normal/unchanged/other
         if resp.message == "file invalidated":
@@ -655,27 +633,18 @@ class ServerInterface(QObject):
             error_type = 10
 
         # ------ Up to here task may be cancelled by timeout ------ #
-        self.server_queue.cancel_scope.shield = True
-        if not self.pending_requests.get(self.request_seq_num):
+        if not self.pending_requests.pop(self.request_seq_num, None):
             # Request has been cancelled
             self.log.info(f"Ignoring server's response for request "
                           f"{self.request_seq_num} (task has been cancelled)")
             return
 
-        self.pending_requests.pop(self.request_seq_num)
-
         self.log.debug(_("After request"))
 
-        if hasattr(self.update_ended, "emit"):
-            self.update_ended.emit()
+        self.update_ended.emit()
 
         # (3) Lean errors?
-        error_list = []
-        try:
-            while True:
-                error_list.append(self.error_recv.receive_nowait())
-        except trio.WouldBlock:
-            pass
+        error_list = self.__received_errors()
         if error_list:
             error_type = 1
 
@@ -695,10 +664,13 @@ class ServerInterface(QObject):
             self.lean_response.emit(lean_response)
 
         self.log.debug(f"End of request #{str(resp.seq_num)}")
-        # Timeout TODO: move this at the end
-        # FIXME: useful??
-        with trio.move_on_after(1):
-            await self.lean_server.running_monitor.wait_ready()
+        # Wait for Lean to stop running. wait_ready() waits for the next
+        # change of state, so it would only time out if Lean has already
+        # stopped. The response has been processed, so shield this last
+        # await from the task's timeout and cancellation.
+        if self.is_running:
+            with trio.CancelScope(shield=True), trio.move_on_after(1):
+                await self.lean_server.running_monitor.wait_ready()
 
     async def set_exercise(self, task, proof_step, exercise: Exercise):
         """
@@ -802,11 +774,11 @@ class ServerInterface(QObject):
             # Formatting. We do NOT want the "no_meta_vars" tactic!
             code_string = code.to_code(exclude_no_meta_vars=True,
                                        exclude_skip=True)
+            # Ensure code ends with ",\n"
             code_string = code_string.strip()
             if not code_string.endswith(","):
                 code_string += ","
-            if not code_string.endswith("\n"):
-                code_string += "\n"
+            code_string += "\n"
 
             lean_file = self.lean_file
             label = lean_file.history[lean_file.target_idx].label
@@ -835,33 +807,24 @@ class ServerInterface(QObject):
                        on_top=False):
         """
         This method takes a list of statements and split it into lists of
-        length ≤ self.MAX_CAPACITY before calling
-        self.get_initial_proof_states. This is a recursive method.
+        length ≤ self.MAX_CAPACITY, each of which is processed by a single
+        call to self.get_initial_proof_states, i.e. a single Lean request.
         """
 
-        statements = list(statements)  # Just in case statements is an iterator
         if statements is None:
             statements = course.statements
+        statements = list(statements)  # Just in case statements is an iterator
 
-        if not statements:
-            pass
-
-        elif len(statements) <= self.MAX_CAPACITY:
+        if len(statements) > self.MAX_CAPACITY:
+            self.log.debug(f"{len(statements)} statements to process...")
 
-            self.log.debug(f"Set {len(statements)} statement(s)")
+        for idx in range(0, len(statements), self.MAX_CAPACITY):
+            batch = statements[idx:idx + self.MAX_CAPACITY]
+            self.log.debug(f"Set {len(batch)} statement(s)")
             task = Task(fct=self.__get_initial_proof_states,
                         kwargs={'course': course,
-                                'statements': statements,
+                                'statements': batch,
                                 'on_top': on_top,
                                 'pertinent_duration': False})
             self.server_queue.add_task(task)
 
-        else:
-
-            self.log.debug(f"{len(statements)} statements to process...")
-            # Split statements
-            self.set_statements(course, statements[:self.MAX_CAPACITY],
-                                on_top=on_top)
-            self.set_statements(course, statements[self.MAX_CAPACITY:],
-                                on_top=on_top)
-
@@ -48,7 +48,6 @@ This file is part of d∃∀duction.
 
 from typing import Dict, List
 import logging
-from copy import deepcopy
 
 from deaduction.pylib.editing import LeanFile
 from deaduction.pylib.coursedata import Course
@@ -300,9 +299,8 @@ class ProofStepRequest(HighLevelServerRequest):
         self.code_string = ""
         self.decorated_code = None  # will be decorated_code
         self.compute_code_string()
-        # self.effective_code = (deepcopy(self.decorated_code)
-        #                        if self.decorated_code else None)
-        # FIXME: the following seems to work:
+        # No deepcopy needed: select_or_else() builds new nodes
+        # instead of modifying the code tree.
         self.effective_code = (self.decorated_code.copy()
                                if self.decorated_code else None)
         self.__from_previous_state_method = from_previous_proof_state_method
@@ -374,7 +372,7 @@ class ProofStepRequest(HighLevelServerRequest):
             contents = self.__file_contents_from_previous_state(goal,
                                                                 self.code_string)
             self.log.info('Using from state method for Lean server')
-            print(contents)
+            self.log.debug(contents)
             return contents
         else:
             return self.lean_file.contents